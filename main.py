@@ -3,30 +3,61 @@ from machine import Pin, PWM
 import tm1637
 import urandom as random
 import time
-
-
-class SimpleQueue:
-    def __init__(self):
-        self._queue = []
+import array
+import ustruct as struct
+import micropython
+from micropython import const
+
+# 讓按鈕中斷內的例外能被回報
+micropython.alloc_emergency_exception_buf(100)
+# 全暗的顯示畫面
+_BLANK = bytes(4)
+# 按壓超過此毫秒數視為長按
+_LONG_PRESS_MS = const(500)
+# 腳位變動後等待彈跳結束的毫秒數
+_DEBOUNCE_MS = const(20)
+# 00~99 的七段碼，第 2n、2n+1 個位元組為 n 的十位與個位
+_MMSS = bytearray(200)
+for _n in range(100):
+    _MMSS[2 * _n] = tm1637._SEGMENTS[_n // 10]
+    _MMSS[2 * _n + 1] = tm1637._SEGMENTS[_n % 10]
+del _n
+
+
+class RingQueue:
+    def __init__(self, n: int):
+        # 固定容量的環狀緩衝區，不會隨 put 增長
+        self.buf = [None] * n
+        self.n = n
+        self.r = 0
+        self.w = 0
+        self.sz = 0
         self._ev = asyncio.Event()
 
     def qsize(self):
-        return len(self._queue)
+        return self.sz
 
     def empty(self):
-        return len(self._queue) == 0
-
-    async def put(self, item):
-        self._queue.append(item)
+        return self.sz == 0
+
+    def put(self, item):
+        if self.sz == self.n:
+            raise IndexError("put to a full queue")
+        self.buf[self.w] = item
+        self.w = (self.w + 1) % self.n
+        self.sz += 1
         self._ev.set()  # 通知有新項目
 
     async def get(self):
-        while self.empty():
+        while self.sz == 0:
+            # 先清除再等待，事件只在空佇列時才需要
+            self._ev.clear()
             await self._ev.wait()  # 等待新項目事件
 
-        item = self._queue.pop(0)
-        if self.empty():
-            self._ev.clear()  # 佇列空了，清除事件標誌
+        item = self.buf[self.r]
+        self.buf[self.r] = None
+        self.r = (self.r + 1) % self.n
+        self.sz -= 1
         return item
 
 
@@ -48,39 +79,68 @@ class AsyncLooping:
             await self.loop_task
 
 
-class Button(Pin, AsyncLooping):
-    def __init__(self, pin_number: int):
-        super().__init__(pin_number, Pin.IN)
-        self.state = False
-        self.on_pressed = None
-        self.on_released = None
-
-    @property
-    def is_pressed(self) -> bool:
-        return not self.value()
+class ButtonBank(AsyncLooping):
+    def __init__(self, *pin_numbers: int):
+        AsyncLooping.__init__(self)
+        self.pins = [Pin(n, Pin.IN) for n in pin_numbers]
+        # 第 i 個位元為第 i 顆按鈕是否按下
+        self.state = 0
+        self.on_pressed = [None] * len(self.pins)
+        self.on_released = [None] * len(self.pins)
+        # 所有腳位共用一個旗標，排程器中按鈕只佔一個等待項目、沒有計時器
+        self._flag = asyncio.ThreadSafeFlag()
+        # 先存下綁定方法，避免中斷時配置記憶體
+        self._isr = self._on_irq
+        for pin in self.pins:
+            pin.irq(handler=self._isr, trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING)
+
+    def _on_irq(self, pin):
+        self._flag.set()
+
+    def read(self) -> int:
+        # 低電位為按下
+        pressed = 0
+        for i, pin in enumerate(self.pins):
+            if not pin.value():
+                pressed |= 1 << i
+        return pressed
 
     async def loop(self):
         while self.loop_runing:
-            await asyncio.sleep(0.01)
-            is_pressed = self.is_pressed
+            # 等待任一腳位中斷
+            await self._flag.wait()
+            # 按下或放開都先等彈跳結束再讀取，彈跳期間的中斷只會多讀一次相同狀態
+            await asyncio.sleep_ms(_DEBOUNCE_MS)
+            if not self.loop_runing:
+                break
+            pressed = self.read()
             # 有無變動
-            if not is_pressed ^ self.state:
-                continue
-            self.state = is_pressed
+            changed = pressed ^ self.state
+            self.state = pressed
             # 觸發事件
-            if is_pressed:
-                if self.on_pressed is not None:
-                    await self.on_pressed()
-            else:
-                if self.on_released is not None:
-                    await self.on_released()
-
-    def set_on_pressed(self, callback) -> "Button":
-        self.on_pressed = callback
+            for i in range(len(self.pins)):
+                bit = 1 << i
+                if not changed & bit:
+                    continue
+                if pressed & bit:
+                    callback = self.on_pressed[i]
+                else:
+                    callback = self.on_released[i]
+                if callback is not None:
+                    await callback()
+
+    async def stop(self):
+        self.loop_runing = False
+        # 喚醒等待中斷的迴圈，讓它結束
+        self._flag.set()
+        await AsyncLooping.stop(self)
+
+    def set_on_pressed(self, index: int, callback) -> "ButtonBank":
+        self.on_pressed[index] = callback
         return self
 
-    def set_on_released(self, callback) -> "Button":
-        self.on_released = callback
+    def set_on_released(self, index: int, callback) -> "ButtonBank":
+        self.on_released[index] = callback
         return self
 
 
@@ -89,11 +149,34 @@ class Buzzer(PWM):
         super().__init__(Pin(pin_number, Pin.OUT))
         self.freq(0)
         self.duty(16000)
+        self._cur_freq = 0
+
+    def set_freq(self, freq: int):
+        # 頻率沒變就不重設 PWM
+        if freq != self._cur_freq:
+            self.freq(freq)
+            self._cur_freq = freq
+
+    def mute(self):
+        self.set_freq(0)
 
     async def play(self, time: float, freq: int = 0):
-        self.freq(freq)
+        # 播完不歸零，連續音符直接換頻率；需要靜音時呼叫 silence/mute
+        self.set_freq(freq)
         await asyncio.sleep(time)
-        self.freq(0)
+
+    async def silence(self, time: float):
+        self.mute()
+        await asyncio.sleep(time)
+
+    async def play_ms(self, time_ms: int, freq: int = 0):
+        # 同 play，以整數毫秒計時
+        self.set_freq(freq)
+        await asyncio.sleep_ms(time_ms)
+
+    async def silence_ms(self, time_ms: int):
+        self.mute()
+        await asyncio.sleep_ms(time_ms)
 
 
 class Led(Pin):
@@ -123,6 +206,7 @@ class DigitalDisplay(tm1637.TM1637, AsyncLooping):
         self.timeup_callback = None
         self.is_pause = False
         self.is_show = True
+        self._frame = bytearray(4)
 
     def pause(self):
         self.is_pause = True
@@ -130,15 +214,28 @@ class DigitalDisplay(tm1637.TM1637, AsyncLooping):
     def set_timeup_callback(self, callback):
         self.timeup_callback = callback
 
+    def show_time(self):
+        # 查表組出「分:秒」，等同 numbers(minute, second)
+        frame = self._frame
+        minute = self.minute * 2
+        second = self.second * 2
+        frame[0] = _MMSS[minute]
+        frame[1] = _MMSS[minute + 1] | 0x80  # 冒號
+        frame[2] = _MMSS[second]
+        frame[3] = _MMSS[second + 1]
+        self.write(frame)
+
     async def loop(self):
+        # 以固定的截止時間倒數，避免 sleep 誤差累積
+        deadline = time.ticks_add(time.ticks_ms(), 1000)
         while self.loop_runing:
             if self.is_pause:
                 await asyncio.sleep(0.5)
                 self.is_show = not self.is_show
                 if self.is_show:
-                    self.numbers(self.minute, self.second)
+                    self.show_time()
                 else:
-                    self.write([0b00000000, 0b00000000, 0b00000000, 0b00000000])
+                    self.write(_BLANK)
                 continue
             self.second -= 1
             # 秒借位
@@ -149,8 +246,9 @@ class DigitalDisplay(tm1637.TM1637, AsyncLooping):
             if self.minute < 0:
                 self.minute = 0
             # 更新顯示
-            self.numbers(self.minute, self.second)
-            await asyncio.sleep(1)
+            self.show_time()
+            await asyncio.sleep_ms(max(0, time.ticks_diff(deadline, time.ticks_ms())))
+            deadline = time.ticks_add(deadline, 1000)
             # 時間到
             if self.second == 0 and self.minute == 0:
                 # 停止迴圈
@@ -163,61 +261,66 @@ class DigitalDisplay(tm1637.TM1637, AsyncLooping):
         quotient, second = divmod(second, 60)
         minute += quotient
         self.second = second
-        self.minute = minute
+        # 顯示器只有兩位數
+        self.minute = min(minute, 99)
 
 
 # led = Led(5)
 buzzer = Buzzer(5)
 digital_display = DigitalDisplay(clk_pin=2, dio_pin=0)
-up_left_button = Button(17)
-up_right_button = Button(12)
-down_left_button = Button(16)
-down_right_button = Button(14)
-up_left_button.start()
-up_right_button.start()
-down_left_button.start()
-down_right_button.start()
-transfer_queue = SimpleQueue()
+# 按鈕編號即 ButtonBank 中的位元
+UP_LEFT = 0
+UP_RIGHT = 1
+DOWN_LEFT = 2
+DOWN_RIGHT = 3
+_ALL_BUTTONS = (UP_LEFT, UP_RIGHT, DOWN_LEFT, DOWN_RIGHT)
+# 長短音關卡的按鈕順序：左上、右下、右上、左下
+_MORSE_BTN_ORDER = (UP_LEFT, DOWN_RIGHT, UP_RIGHT, DOWN_LEFT)
+buttons = ButtonBank(17, 12, 16, 14)
+buttons.start()
+transfer_queue = RingQueue(4)
+# 轉移代號，由 main 在取出時才建立對應的協程
+TRANSFER_LOSE = 1
+TRANSFER_WIN = 2
+TRANSFER_GAME = 3
+TRANSFER_MORSE = 4
+TRANSFER_PITCH = 5
+# 有放開或轉移時通知等待中的關卡
+round_event = asyncio.Event()
+# 本回合是否已送出輸贏，避免同時贏又輸
+_transfer_fired = False
 play_task: asyncio.Task | None = None
 
 
 async def death_sound():
     await buzzer.play(2.0, 980)
     await buzzer.play(1, 64)
-    await asyncio.sleep(0.5)
+    await buzzer.silence(0.5)
     for hz in range(512, 64, -32):
         await buzzer.play(0.1, hz)
+    buzzer.mute()
 
 
 async def win_sound():
     for hz in range(150, 720, 32):
         await buzzer.play(0.03, hz)
     for _ in range(3):
-        await asyncio.sleep(0.05)
+        await buzzer.silence(0.05)
         await buzzer.play(0.2, 760)
     await buzzer.play(1, 860)
+    buzzer.mute()
 
 
 async def game_over():
-    if play_task is not None:
-        play_task.cancel()
     digital_display.write([0b11111111, 0b11111111, 0b11111111, 0b11111111])
-    await up_left_button.stop()
-    await up_right_button.stop()
-    await down_left_button.stop()
-    await down_right_button.stop()
+    await buttons.stop()
     await digital_display.stop()
     await death_sound()
-    digital_display.write([0b00000000, 0b00000000, 0b00000000, 0b00000000])
+    digital_display.write(_BLANK)
 
 
 async def game_win():
-    if play_task is not None:
-        play_task.cancel()
-    await up_left_button.stop()
-    await up_right_button.stop()
-    await down_left_button.stop()
-    await down_right_button.stop()
+    await buttons.stop()
     # 暫停數字顯示器(閃爍)
     digital_display.pause()
     await win_sound()
@@ -225,40 +328,81 @@ async def game_win():
     await asyncio.sleep(600)
 
 
+def stop_play():
+    global play_task
+    if play_task is not None:
+        play_task.cancel()
+        play_task = None
+    buzzer.mute()
+
+
 async def transfer_to_win():
-    await transfer_queue.put(game_win())
+    global _transfer_fired
+    if _transfer_fired:
+        return
+    _transfer_fired = True
+    # 先停掉提示音，不必等轉移被取出
+    stop_play()
+    transfer_queue.put(TRANSFER_WIN)
+    round_event.set()
 
 
 async def transfer_to_lose():
-    await transfer_queue.put(game_over())
+    global _transfer_fired
+    if _transfer_fired:
+        return
+    _transfer_fired = True
+    stop_play()
+    transfer_queue.put(TRANSFER_LOSE)
+    round_event.set()
 
 
-async def play_morse(tape: list[int]):
-    try:
-        while True:
-            for i in tape:
-                if i == 0:
-                    await asyncio.sleep(0.25)
-                    await buzzer.play(0.25, 548)
-                    await asyncio.sleep(0.25)
-                else:
-                    await buzzer.play(1, 548)
-                await asyncio.sleep(0.1)
-            await asyncio.sleep(1.5)
-    except asyncio.CancelledError:
-        pass
+# 音帶指令：每筆 4 個位元組 <指令, 頻率(2), 長度(百分之一秒)>
+_OP_BEEP = const(1)
+_OP_REST = const(2)
+_OP_LOOP = const(3)
+
+
+def _beep(freq: int, duration: int) -> bytes:
+    return struct.pack("<BHB", _OP_BEEP, freq, duration)
+
+
+def _rest(duration: int) -> bytes:
+    return struct.pack("<BHB", _OP_REST, 0, duration)
 
 
-async def play_pitch(tape: list[int]):
+# 以音符(0短1長)為索引的片段，含音符間隔
+_MORSE_NOTES = (
+    _rest(25) + _beep(548, 25) + _rest(35),
+    _beep(548, 100) + _rest(10),
+)
+# 以音符(0低1高)為索引的片段
+_PITCH_NOTES = (
+    _beep(368, 50) + _rest(10),
+    _beep(762, 50) + _rest(10),
+)
+# 每輪結尾停頓後重播
+_TAPE_END = _rest(150) + struct.pack("<BHB", _OP_LOOP, 0, 0)
+
+
+def compile_tape(notes: tuple, tape) -> bytes:
+    return b"".join([notes[i] for i in tape]) + _TAPE_END
+
+
+async def play_tape(program: bytes):
+    mv = memoryview(program)
+    i = 0
     try:
         while True:
-            for i in tape:
-                if i == 0:
-                    await buzzer.play(0.5, 368)
-                else:
-                    await buzzer.play(0.5, 762)
-                await asyncio.sleep(0.1)
-            await asyncio.sleep(1.5)
+            op = mv[i]
+            if op == _OP_BEEP:
+                await buzzer.play_ms(mv[i + 3] * 10, mv[i + 1] | (mv[i + 2] << 8))
+            elif op == _OP_REST:
+                await buzzer.silence_ms(mv[i + 3] * 10)
+            elif op == _OP_LOOP:
+                i = 0
+                continue
+            i += 4
     except asyncio.CancelledError:
         pass
 
@@ -270,67 +414,60 @@ async def morse():  # 長短音
     # 隨機資料(4隨機，其中最少1)
     code = [random.randint(0, 1) for _ in range(4)]
     code[random.randint(0, 3)] = 1  # 至少一個為1
-    tape = [mode, 1] + code
-    play_task = asyncio.create_task(play_morse(tape))
+    program = compile_tape(_MORSE_NOTES, [mode, 1] + code)
+    play_task = asyncio.create_task(play_tape(program))
 
     # ==短長==
     if mode == 0:
         set_all_buttons_with(transfer_to_lose)
         count = sum(code) - 1
-        b = [
-            up_left_button,
-            down_right_button,
-            up_right_button,
-            down_left_button,
-        ][count]
-        b.set_on_pressed(transfer_to_win)
+        b = _MORSE_BTN_ORDER[count]
+        buttons.set_on_pressed(b, transfer_to_win)
 
     # ==長長==
     if mode == 1:
-        for long, b in zip(
-            code,
-            [
-                up_left_button,
-                down_right_button,
-                up_right_button,
-                down_left_button,
-            ],
-        ):
+        for long, b in zip(code, _MORSE_BTN_ORDER):
             # i是長短，b是按鈕
             set_all_buttons_with(transfer_to_lose)
-            time_queue = SimpleQueue()
+            # 按下與放開時間(ticks_ms)，[1] 為是否已記錄
+            press_ts = array.array("i", [0, 0])
+            release_ts = array.array("i", [0, 0])
+            round_event.clear()
 
             async def record_press_time():
-                await time_queue.put((time.time(), "press"))
+                # 已放開就不再覆寫，避免再次按下讓按壓時間變成負的
+                if release_ts[1]:
+                    return
+                press_ts[0] = time.ticks_ms()
+                press_ts[1] = 1
 
             async def record_release_time():
-                await time_queue.put((time.time(), "release"))
+                # 上一關還沒放開，忽略沒有對應按下的放開
+                if press_ts[1]:
+                    release_ts[0] = time.ticks_ms()
+                    release_ts[1] = 1
+                    round_event.set()
 
             # 記錄按下與放開時間
-            b.set_on_pressed(record_press_time).set_on_released(record_release_time)
+            buttons.set_on_pressed(b, record_press_time).set_on_released(
+                b, record_release_time
+            )
             # 等待直到任意按鈕
-            while time_queue.qsize() < 2 and transfer_queue.empty():
+            while not release_ts[1] and transfer_queue.empty():
                 # 等待任意按鈕
-                await asyncio.sleep(0.05)
+                await round_event.wait()
+                round_event.clear()
             # 有轉移(按錯按鈕)
             if not transfer_queue.empty():
                 print("跳出!!")
                 return
-            # 上一關還沒放開
-            if time_queue._queue[0][1] == "release":
-                # 清掉遺存
-                await time_queue.get()
             # 按對按鈕
-            press_time, _ = await time_queue.get()
-            release_time, _ = await time_queue.get()
-            hold_time = abs(release_time - press_time)
-            is_hold_long = hold_time > 0.5
-            if long ^ is_hold_long:
-                # 按壓時間不同
+            hold_time_ms = time.ticks_diff(release_ts[0], press_ts[0])
+            is_hold_long = hold_time_ms > _LONG_PRESS_MS
+            if long != is_hold_long:
+                # 按壓時間不同，不用再等後面的按鈕
                 await transfer_to_lose()
-            else:
-                # 按壓時間相同
-                continue
+                return
         await transfer_to_win()
 
 
@@ -344,43 +481,51 @@ async def pitch():  # 音高
     up = random.randint(0, 1)
     # 0左1右
     right = random.randint(0, 1)
-    tape = [mode, mode ^ 1, long, up, right]
-    play_task = asyncio.create_task(play_pitch(tape))
+    program = compile_tape(_PITCH_NOTES, (mode, mode ^ 1, long, up, right))
+    play_task = asyncio.create_task(play_tape(program))
 
     set_all_buttons_with(transfer_to_lose)
     # ==低高==
     if mode == 0:  # 記錄按下與放開時間
         b = [
-            [down_left_button, down_right_button],
-            [up_left_button, up_right_button],
+            [DOWN_LEFT, DOWN_RIGHT],
+            [UP_LEFT, UP_RIGHT],
         ][
             up
         ][right]
-        time_queue = SimpleQueue()
+        # 按下與放開時間(ticks_ms)，[1] 為是否已記錄
+        press_ts = array.array("i", [0, 0])
+        release_ts = array.array("i", [0, 0])
+        round_event.clear()
 
         async def record_press_time():
-            await time_queue.put((time.time(), "press"))
+            # 已放開就不再覆寫，避免再次按下讓按壓時間變成負的
+            if release_ts[1]:
+                return
+            press_ts[0] = time.ticks_ms()
+            press_ts[1] = 1
 
         async def record_release_time():
-            await time_queue.put((time.time(), "release"))
-
-        b.set_on_pressed(record_press_time).set_on_released(record_release_time)
+            # 上一關還沒放開，忽略沒有對應按下的放開
+            if press_ts[1]:
+                release_ts[0] = time.ticks_ms()
+                release_ts[1] = 1
+                round_event.set()
+
+        buttons.set_on_pressed(b, record_press_time).set_on_released(
+            b, record_release_time
+        )
         # 等待直到任意按鈕
-        while time_queue.qsize() < 2 and transfer_queue.empty():
-            await asyncio.sleep(0.05)
-        # 上一關還沒放開
-        if time_queue._queue[0][1] == "release":
-            # 清掉遺存
-            await time_queue.get()
+        while not release_ts[1] and transfer_queue.empty():
+            await round_event.wait()
+            round_event.clear()
         # 有轉移(按錯按鈕)
         if not transfer_queue.empty():
             return
         # 按對按鈕
-        press_time, _ = await time_queue.get()
-        release_time, _ = await time_queue.get()
-        hold_time = release_time - press_time
-        is_hold_long = hold_time > 0.5
-        if long ^ is_hold_long:
+        hold_time_ms = time.ticks_diff(release_ts[0], press_ts[0])
+        is_hold_long = hold_time_ms > _LONG_PRESS_MS
+        if long != is_hold_long:
             # 按壓時間不同
             await transfer_to_lose()
         else:
@@ -388,50 +533,57 @@ async def pitch():  # 音高
             await transfer_to_win()
     # ==高低==
     if mode == 1:
-        b = [down_left_button, up_right_button][right]
-        b.set_on_pressed(transfer_to_win)
+        b = [DOWN_LEFT, UP_RIGHT][right]
+        buttons.set_on_pressed(b, transfer_to_win)
 
 
 async def game(time: int = 60 * 3):
+    global _transfer_fired
+    # 新回合
+    _transfer_fired = False
     digital_display.set_timeup_callback(transfer_to_lose)
     digital_display.set_time(time)
     digital_display.start()
     # 隨機遊戲模組
     if random.randint(0, 1):
-        await transfer_queue.put(morse())
+        transfer_queue.put(TRANSFER_MORSE)
     else:
-        await transfer_queue.put(pitch())
+        transfer_queue.put(TRANSFER_PITCH)
 
 
 def set_all_buttons_with(func):
-    up_left_button.set_on_pressed(func)
-    up_right_button.set_on_pressed(func)
-    down_left_button.set_on_pressed(func)
-    down_right_button.set_on_pressed(func)
+    # 一併清掉上一關留下的放開事件
+    for b in _ALL_BUTTONS:
+        buttons.on_pressed[b] = func
+        buttons.on_released[b] = None
+
+
+# 以轉移代號為索引
+_TRANSFERS = (None, game_over, game_win, game, morse, pitch)
 
 
 async def main():
     set_all_buttons_with(transfer_to_lose)
     position_for_start = random.randint(0, 3)
     t, b = [
-        ([0b01100011, 0b00000000, 0b00000000, 0b00000000], up_left_button),
-        ([0b00000000, 0b00000000, 0b00000000, 0b01100011], up_right_button),
-        ([0b01011100, 0b00000000, 0b00000000, 0b00000000], down_left_button),
-        ([0b00000000, 0b00000000, 0b00000000, 0b01011100], down_right_button),
+        ([0b01100011, 0b00000000, 0b00000000, 0b00000000], UP_LEFT),
+        ([0b00000000, 0b00000000, 0b00000000, 0b01100011], UP_RIGHT),
+        ([0b01011100, 0b00000000, 0b00000000, 0b00000000], DOWN_LEFT),
+        ([0b00000000, 0b00000000, 0b00000000, 0b01011100], DOWN_RIGHT),
     ][position_for_start]
     digital_display.write(t)
 
     async def transfer_to_game():
-        await transfer_queue.put(game())
+        transfer_queue.put(TRANSFER_GAME)
 
-    b.set_on_pressed(transfer_to_game)
+    buttons.set_on_pressed(b, transfer_to_game)
 
     # 跑主要線路
     while True:
         print("嘗試拿")
-        transfer = await transfer_queue.get()
+        tag = await transfer_queue.get()
         print("拿到")
-        await transfer
+        await _TRANSFERS[tag]()
 
 
 if __name__ == "__main__":